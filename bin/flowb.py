@@ -6,94 +6,550 @@ import json
 import subprocess 
 import re
 import signal
+import shutil
+import tempfile
+import mmap
+import gzip
+import bz2
+import lzma
+import fnmatch
+import heapq
+import traceback
 from pprint import pprint,pformat
-from time import ctime,sleep
-from threading import Timer
+from time import ctime,sleep,monotonic
+from threading import Thread,Condition,Lock,current_thread
+from itertools import count
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
 
 PATHS         = {}
-TASKS         = []
 OPTS          = {}
-STAGE_TIMER   = None
-STAGE_TIMEOUT = False
+FLOWS         = []
+SCHEDULER     = None
+BG_POOL       = None        # Background work - scratch copy-back, log indexing
+CHANGES       = None        # Changed files (--changed_since/--changed_files), None runs everything
+TIMERS        = None        # Every task and stage timeout
+RUNNING       = {}          # pid -> (flow,Task) of every running task
+REAP_LOCK     = Lock()
+POLL_SEC      = 1
+SLOT_SEC      = 0.1         # How often a flow waiting for worker slots reaps its tasks
 GENERIC_ERROR = False
+TIMEOUT_FAIL  = "FAIL: Task timed out"
+
+# cgroup v2 state - Filled in by cgroup_init() the first time a task asks for limits
+CGROUP        = {
+    'init'        : False,
+    'root'        : None,       # flowb-<pid> directory task cgroups are created under
+    'main'        : None,       # flowb-<pid>.main leaf flowb moved itself into (if it had to)
+    'base_enabled': [],         # Controllers we turned on in the cgroup flowb started in
+    'controllers' : [],         # Controllers enabled for the task cgroups
+    'ids'         : count(),
+}
+CGROUP_CONTROLLERS = {
+    'cpu_quota'  : 'cpu',
+    'memory_max' : 'memory',
+    'io_weight'  : 'io',
+}
+CGROUP_CPU_PERIOD  = 100000
+CGROUP_LIMITS      = {
+    'cpu_quota'  : "a number of CPUs >= 0.01 (i.e. 1.5)",
+    'memory_max' : "a size in bytes or K,M,G,T suffixed (i.e. 2G)",
+    'io_weight'  : "an integer 1-10000",
+}
+
+# Scratch areas tasks can run in instead of their task_dir
+#   budget    - Bytes tasks may reserve (running + waiting on copy-back), None for no limit
+#   reserved  - Bytes reserved by the live scratch dirs
+#   live      - Scratch dirs in use -> bytes reserved
+SCRATCH       = {
+    'tmpfs' : {'dir' : "/dev/shm",             'budget' : None, 'reserved' : 0, 'live' : {}},
+    'local' : {'dir' : tempfile.gettempdir(),  'budget' : None, 'reserved' : 0, 'live' : {}},
+}
+SCRATCH_LOCK     = Lock()
+SCRATCH_MIN_FREE = 256 * 1024**2
+SCRATCH_SIZE     = 512 * 1024**2    # Reserved by a task without scratch_size
+SCRATCH_SPILL    = {
+    'tmpfs' : ['tmpfs','local'],
+    'local' : ['local'],
+}
+
+# Task logs - output.log plus rotated (output.log.1) and compressed (.gz .bz2 .xz) copies
+LOG_FILE_RE   = re.compile(r'^output\.log(?:\.(\d+))?(?:\.(gz|bz2|xz))?$')
+LOG_OPENERS   = {'gz' : gzip.open, 'bz2' : bz2.open, 'xz' : lzma.open}
+LOG_ERROR     = r'(?i)\b(?:error|fatal|exception|traceback)\b'
+LOG_WARNING   = r'(?i)\bwarn(?:ing)?\b'
+LOG_INDEX_MAX = 100         # Lines of each kind kept in log_index.json
+LOG_CHUNK     = 1024**2     # Bytes of a log counted at a time
 
 class Task():
     '''
     Holds the task information as well as the actual proc
+    Only the fields needed while the task runs are kept - flows can have 100k+ tasks
     '''
-    def __init__(self,p,**kwargs):
+    FIELDS = ('name','task_dir','log_file','timeout_sec','memory_max','cgroup',
+              'scratch_dir','stream_from','stream_in','stream_out')
+
+    __slots__ = FIELDS + ('p','name_uniq','fail_reason','usage','killed','_timer',
+                          'stream_producer','stream_consumer','stream_eof','stream_epipe')
+
+    def __init__(self,p,task):
         
-        # Take any keyword arguments and assign them to the dictionary
-        for item in kwargs:
-            self.__dict__[item] = kwargs[item]
+        # Take the fields we need from the task dictionary
+        for item in self.FIELDS:
+            setattr(self,item,task[item])
 
         self.p           = p
         self.name_uniq   = "{}-{}".format(self.name,p.pid)
         self._timer      = None
         self.fail_reason = None
+        self.usage       = None
+        self.killed      = False
+
+        # Streamed partners (Task objects) - linked by stream_link()
+        self.stream_producer = None
+        self.stream_consumer = None
+        self.stream_eof      = False
+        self.stream_epipe    = False
 
         if self.timeout_sec:
-            self._timer_start(self.timeout_sec)
+            self._timer = TIMERS.start(self.timeout_sec,self._task_timeout)
 
     def __getitem__(self,item):
         return getattr(self,item)
 
-    def _task_timeout(self,**kwargs):
+    def _task_timeout(self):
         info("** TASK TIMEOUT ** [{}]".format(self.name_uniq))
-        self.fail_reason = "FAIL: Task timed out"
-        self.p.kill()
-
-    def _timer_start(self,timeout_sec):
-        args = {}
-        #info("Starting timer on proc [{}] for [{}] seconds".format(self.name_uniq,timeout_sec))
-        self._timer = Timer(timeout_sec,self._task_timeout,[],args)
-        self._timer.start()
+        self.fail_reason = TIMEOUT_FAIL
+        self._kill()
+
+    def _kill(self):
+        # A cgroup holds the whole process tree - not just the shell
+        if self.cgroup:
+            cgroup_kill(self.cgroup)
+
+        # Not Popen.kill() - it polls and would reap the child behind procs_reap()
+        # Until procs_reap() has reaped it the pid can't be reused
+        # Streamed tasks lead their own process group - a reader/writer orphaned
+        # opening the pipe has to go too
+        with REAP_LOCK:
+            if self.p.returncode is None:
+                try:
+                    if self.stream_in or self.stream_out:
+                        os.killpg(self.p.pid,signal.SIGKILL)
+                    else:
+                        os.kill(self.p.pid,signal.SIGKILL)
+                except OSError:
+                    pass
 
     def kill(self):
-        self.p.kill()
+        self.killed = True
+        self._kill()
         if self._timer:
-            self._timer.cancel();
+            TIMERS.cancel(self._timer)
             self._timer = None      
     
     def done(self):
         if self._timer:
-            #info("Canceling timer on proc [{}]".format(self.name_uniq))
-            self._timer.cancel();
+            TIMERS.cancel(self._timer)
             self._timer = None      
 
-def stage_timeout(**kwargs):
+        # Collect accounting for the whole task tree and remove the cgroup
+        if self.cgroup:
+            self.usage  = cgroup_done(self.cgroup,self.task_dir)
+            self.cgroup = None
+
+    def oom_killed(self):
+        return bool(self.usage) and self.usage.get('oom_kill',0) > 0
+
+    def stream_sigpipe(self):
+        # Producer died writing to a consumer that PASSed without reading everything (i.e. head)
+        consumer = self.stream_consumer
+        return bool(consumer) and consumer.p.returncode == 0 and not self.killed and \
+               self.p.returncode in (-signal.SIGPIPE,128 + signal.SIGPIPE)
+
+class Timers():
+    '''
+    A single thread running every task and stage timeout.
+    Timeouts are kept in a heap ordered by deadline.  cancel() only marks an
+    entry, it is dropped when it reaches the top of the heap.
+    Callbacks run holding the lock - once cancel() returns the callback
+    either already ran or never will.
+    '''
+    def __init__(self):
+        self._heap   = []
+        self._ids    = count()
+        self._cond   = Condition()
+        self._thread = None
+
+    def start(self,timeout_sec,fn,*args):
+        '''
+        Call fn(*args) in timeout_sec seconds.  Returns an entry for cancel()
+        '''
+        entry = [monotonic() + timeout_sec,next(self._ids),fn,args]
+        with self._cond:
+            heapq.heappush(self._heap,entry)
+            if not self._thread:
+                self._thread = Thread(target=self._run,name="timers")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    def cancel(self,entry):
+        with self._cond:
+            entry[2] = None
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+
+                wait = self._heap[0][0] - monotonic() if self._heap else None
+                if wait is None or wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                (deadline,i,fn,args) = heapq.heappop(self._heap)
+
+                # One bad callback mustn't stop every later timeout
+                try:
+                    fn(*args)
+                except Exception as e:
+                    info("WARNING: Timer callback [{}] failed ({})".format(getattr(fn,"__name__",fn),e))
+
+class Scheduler():
+    '''
+    Pool of worker slots shared by every flow running in this process.
+    A free slot goes to the waiting flow with the highest priority, then to
+    the flow using the smallest part of its weighted share (running/weight).
+    '''
+    def __init__(self,slots=0):
+        self.slots   = slots    # 0 - Unlimited
+        self.running = {}
+        self.waiting = {}
+        self._cond   = Condition()
+
+    def _free(self):
+        return self.slots - sum(self.running.values())
+
+    def _next(self):
+        def share(flow):
+            return (-flow['priority'],self.running.get(flow['name'],0) / float(flow['weight']),flow['name'])
+        return sorted(self.waiting.values(),key=share)[0]
+
+    def acquire(self,flow,n=1,timeout=None):
+        '''
+        Take n slots for a flow.  Returns False if not granted within timeout -
+        the flow keeps its place in the queue until granted or cancel()ed
+        '''
+        with self._cond:
+            if self.slots:
+                self.waiting[flow['name']] = flow
+                need = min(n,self.slots)
+                if not self._cond.wait_for(lambda: self._free() >= need and self._next() is flow,timeout):
+                    return False
+                del self.waiting[flow['name']]
+                self._cond.notify_all()
+            self.running[flow['name']] = self.running.get(flow['name'],0) + n
+            return True
+
+    def cancel(self,flow):
+        '''
+        Give up a flow's place in the queue
+        '''
+        with self._cond:
+            if self.waiting.pop(flow['name'],None):
+                self._cond.notify_all()
+
+    def release(self,flow,n=1):
+        with self._cond:
+            self.running[flow['name']] -= n
+            self._cond.notify_all()
+
+    def drop(self,flow):
+        '''
+        Give back every slot a flow holds and its place in the queue
+        '''
+        with self._cond:
+            self.waiting.pop(flow['name'],None)
+            self.running.pop(flow['name'],None)
+            self._cond.notify_all()
+
+def stage_timeout(flow):
     '''
     Timeout callback function.
     Registered with stage_timer_start
     '''
-    global STAGE_TIMER
-    global STAGE_TIMEOUT
     banner(" STAGE TIMEOUT EVENT ",char='%')
-    STAGE_TIMEOUT=True
+    flow['stage_timeout'] = True
 
-def stage_timer_start(timeout_sec):
+def stage_timer_start(flow,timeout_sec):
     '''
     Start the stage timer
     '''
-    global STAGE_TIMER
-    global STAGE_TIMEOUT
-    STAGE_TIMEOUT = False
-    args = {}
-    STAGE_TIMER = Timer(timeout_sec,stage_timeout,[],args)
-    STAGE_TIMER.start()
+    flow['stage_timeout'] = False
+    flow['stage_timer']   = TIMERS.start(timeout_sec,stage_timeout,flow)
 
-def stage_timer_stop():
+def stage_timer_stop(flow):
     '''
     Stop the stage timer
     '''
-    global STAGE_TIMER
-    global STAGE_TIMEOUT
-
-    if STAGE_TIMER:
-        STAGE_TIMER.cancel()
-        STAGE_TIMER = None
+    if flow['stage_timer']:
+        TIMERS.cancel(flow['stage_timer'])
+        flow['stage_timer'] = None
     
-    STAGE_TIMEOUT = False
+    flow['stage_timeout'] = False
+
+def cgroup_mount():
+    '''
+    Find where the cgroup v2 hierarchy is mounted
+    '''
+    with open("/proc/self/mounts",'r') as fh:
+        for line in fh:
+            fields = line.split()
+            if fields[2] == "cgroup2":
+                return fields[1]
+    return None
+
+def cgroup_write(path,value):
+    with open(path,'w') as fh:
+        fh.write("{}".format(value))
+
+def cgroup_read(path):
+    '''
+    Read a flat keyed cgroup file (i.e. memory.events) into a dict
+    '''
+    data = {}
+    if os.path.exists(path):
+        with open(path,'r') as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) == 2:
+                    data[fields[0]] = int(fields[1])
+    return data
+
+def cgroup_init():
+    '''
+    Setup a cgroup v2 subtree that task cgroups are created under.
+
+    We create flowb-<pid> below the cgroup flowb is running in.  Writing
+    there only needs a delegated subtree (i.e. systemd-run --user -p Delegate=yes)
+    not root.  Controllers can only be handed down from a cgroup without
+    processes, so if our own cgroup is busy flowb moves itself into a leaf.
+    '''
+    global CGROUP
+
+    if CGROUP['init']:
+        return CGROUP['root']
+
+    CGROUP['init'] = True
+
+    mount = cgroup_mount()
+    if not mount:
+        info("WARNING: No cgroup v2 hierarchy mounted - tasks will run without isolation")
+        return None
+
+    with open("/proc/self/cgroup",'r') as fh:
+        own = [x.strip()[3:] for x in fh if x.startswith("0::")]
+    base = os.path.normpath("{}/{}".format(mount,own[0] if own else "/"))
+    root = "{}/flowb-{}".format(base,os.getpid())
+
+    try:
+        dir_create(root)
+    except OSError as e:
+        info("WARNING: Unable to create cgroup [{}] ({}) - tasks will run without isolation".format(root,e))
+        return None
+
+    with open("{}/cgroup.controllers".format(base),'r') as fh:
+        available = fh.read().split()
+    with open("{}/cgroup.subtree_control".format(base),'r') as fh:
+        before = fh.read().split()
+    wanted = [x for x in CGROUP_CONTROLLERS.values() if x in available]
+
+    def enable(d):
+        enabled = []
+        for ctrl in wanted:
+            try:
+                cgroup_write("{}/cgroup.subtree_control".format(d),"+{}".format(ctrl))
+                enabled.append(ctrl)
+            except OSError:
+                pass
+        return enabled
+
+    enabled = enable(base)
+    if len(enabled) != len(wanted):
+        # Our own cgroup has processes in it (us) - move into a leaf and try again
+        leaf = "{}/flowb-{}.main".format(base,os.getpid())
+        try:
+            dir_create(leaf)
+            CGROUP['main'] = leaf
+            cgroup_write("{}/cgroup.procs".format(leaf),os.getpid())
+        except OSError as e:
+            info("WARNING: Unable to move flowb into cgroup [{}] ({})".format(leaf,e))
+        enabled = enable(base)
+
+    CGROUP['root']         = root
+    CGROUP['base_enabled'] = [x for x in enabled if x not in before]
+    CGROUP['controllers'] = [x for x in enable(root) if x in enabled]
+
+    info("cgroup v2 root [{}] controllers {}".format(root,CGROUP['controllers']))
+    return root
+
+def cgroup_create(task):
+    '''
+    Create a cgroup for a task and apply any limits
+    Returns None if the task has no limits or cgroups are unavailable
+    '''
+    limits = [x for x in CGROUP_CONTROLLERS if task[x] is not None]
+    if not limits:
+        return None
+
+    root = cgroup_init()
+    if not root:
+        return None
+
+    name = re.sub(r'[^\w.-]','_',"{}.{}".format(os.path.basename(task['stage_dir']),task['name']))
+    path = "{}/{}.{}".format(root,name,next(CGROUP['ids']))
+
+    # Values were checked by cgroup_limits() - the kernel can still refuse them
+    #   Other tasks of the stage may already run, so don't fail the whole launch
+    try:
+        os.mkdir(path)
+
+        for limit in limits:
+            if CGROUP_CONTROLLERS[limit] not in CGROUP['controllers']:
+                info("WARNING: cgroup controller [{}] unavailable - ignoring {}={}".format(CGROUP_CONTROLLERS[limit],limit,task[limit]))
+                continue
+
+            if limit == 'cpu_quota':
+                # Number of CPUs the task may use (i.e. 1.5)
+                quota = int(task['cpu_quota'] * CGROUP_CPU_PERIOD)
+                cgroup_write("{}/cpu.max".format(path),"{} {}".format(quota,CGROUP_CPU_PERIOD))
+            elif limit == 'memory_max':
+                # Don't let the task hide in swap
+                cgroup_write("{}/memory.max".format(path),task['memory_max'])
+                if os.path.exists("{}/memory.swap.max".format(path)):
+                    cgroup_write("{}/memory.swap.max".format(path),0)
+            elif limit == 'io_weight':
+                cgroup_write("{}/io.weight".format(path),"default {}".format(task['io_weight']))
+    except OSError as e:
+        info("WARNING: Unable to setup cgroup [{}] ({}) - task [{}] will run without isolation".format(path,e,task['name']))
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+        return None
+
+    return path
+
+def cgroup_limits(name,opts):
+    '''
+    Check and convert the cgroup limits of a stage or task (in place)
+    Called for a whole stage before any of its tasks start
+    '''
+    for limit in CGROUP_CONTROLLERS:
+        value = opts.get(limit)
+        if value is None:
+            continue
+
+        try:
+            if limit == 'cpu_quota':
+                value = float(value)
+                valid = value >= 0.01
+            elif limit == 'memory_max':
+                value = size_parse(value)
+                valid = value > 0
+            elif limit == 'io_weight':
+                valid = float(value) == int(value) and 1 <= int(value) <= 10000
+                value = int(value)
+        except (TypeError,ValueError):
+            valid = False
+
+        if not valid:
+            sys.exit("ERROR: [{}] {} must be {} - not [{}]".format(name,limit,CGROUP_LIMITS[limit],opts[limit]))
+        opts[limit] = value
+
+def cgroup_cleanup():
+    '''
+    Remove the flowb-<pid> cgroup once all tasks are done
+    '''
+    if CGROUP['root']:
+        try:
+            os.rmdir(CGROUP['root'])
+        except OSError as e:
+            info("WARNING: Unable to remove cgroup [{}] ({})".format(CGROUP['root'],e))
+        CGROUP['root'] = None
+
+    # Move back to where we started so flowb-<pid>.main can go too
+    #   A cgroup handing controllers down can't hold processes - give back the ones we turned on first
+    if CGROUP['main']:
+        base = os.path.dirname(CGROUP['main'])
+        try:
+            for ctrl in CGROUP['base_enabled']:
+                cgroup_write("{}/cgroup.subtree_control".format(base),"-{}".format(ctrl))
+            cgroup_write("{}/cgroup.procs".format(base),os.getpid())
+            os.rmdir(CGROUP['main'])
+        except OSError as e:
+            info("WARNING: Unable to remove cgroup [{}] ({})".format(CGROUP['main'],e))
+        CGROUP['main'] = None
+
+def cgroup_kill(path):
+    '''
+    Kill every process in a cgroup
+    '''
+    try:
+        cgroup_write("{}/cgroup.kill".format(path),1)
+        return
+    except OSError:
+        pass
+
+    # Kernels older than 5.14 - kill each process
+    try:
+        with open("{}/cgroup.procs".format(path),'r') as fh:
+            pids = [int(x) for x in fh.read().split()]
+    except OSError:
+        pids = []
+
+    for pid in pids:
+        try:
+            os.kill(pid,signal.SIGKILL)
+        except OSError:
+            pass
+
+def cgroup_done(path,task_dir):
+    '''
+    Collect accounting for a finished task then remove its cgroup
+    Usage is written to <task_dir>/usage.json
+    '''
+    cpu    = cgroup_read("{}/cpu.stat".format(path))
+    events = cgroup_read("{}/memory.events".format(path))
+    usage  = {
+        'cpu_usec'    : cpu.get('usage_usec'),
+        'user_usec'   : cpu.get('user_usec'),
+        'system_usec' : cpu.get('system_usec'),
+        'memory_peak' : None,
+        'oom_kill'    : events.get('oom_kill',0),
+    }
+
+    peak = "{}/memory.peak".format(path)
+    if os.path.exists(peak):
+        with open(peak,'r') as fh:
+            usage['memory_peak'] = int(fh.read())
+
+    with open("{}/usage.json".format(task_dir),'w') as outfile:
+        json.dump(usage,outfile,indent=4,sort_keys=True)
+
+    # Background children may still be exiting
+    for attempt in range(10):
+        try:
+            os.rmdir(path)
+            break
+        except OSError:
+            cgroup_kill(path)
+            sleep(0.1)
+
+    return usage
 
 def resolve_file(f,dirs=[],exts=[]):
     '''
@@ -128,12 +584,145 @@ def dir_create(d):
     if not os.path.exists(d):
         os.mkdir(d)
 
+def size_parse(size):
+    '''
+    Convert a size (i.e. 512M, 2G) to bytes
+    '''
+    units = {'':1,'K':1024,'M':1024**2,'G':1024**3,'T':1024**4}
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$',"{}".format(size),re.I)
+    if not match:
+        sys.exit("ERROR: Unable to parse size [{}]".format(size))
+    return int(float(match.group(1)) * units[match.group(2).upper()])
+
+def scratch_init():
+    '''
+    Apply --scratch_dir and --scratch_budget options <kind>=<value>
+    '''
+    for (opt,key) in (('scratch_dir','dir'),('scratch_budget','budget')):
+        for item in OPTS[opt] or []:
+            kind,_,value = item.partition('=')
+            if kind not in SCRATCH:
+                sys.exit("ERROR: Unknown scratch kind [{}] in --{} {}".format(kind,opt,item))
+            SCRATCH[kind][key] = size_parse(value) if key == 'budget' else value
+
+    # Keep our scratch areas apart from other flowb processes
+    for kind in SCRATCH:
+        SCRATCH[kind]['root'] = "{}/flowb-{}-{}".format(SCRATCH[kind]['dir'],os.environ.get('USER','flowb'),os.getpid())
+
+def scratch_full(kind,size):
+    '''
+    Would reserving size bytes put a scratch area over its budget or out of space
+    Scratch dirs are empty at launch - the budget counts reservations, not usage
+    '''
+    area = SCRATCH[kind]
+
+    if not os.path.isdir(area['dir']):
+        return True
+    if shutil.disk_usage(area['dir']).free < size + SCRATCH_MIN_FREE:
+        return True
+    if area['budget'] is not None and area['reserved'] + size > area['budget']:
+        return True
+
+    return False
+
+def scratch_create(flow,task):
+    '''
+    Create the scratch directory a task runs in
+    Spills to the next scratch area (then task_dir) when one is full
+    Returns None when the task should run in its task_dir
+    '''
+    if not task['scratch']:
+        return None
+
+    kinds = SCRATCH_SPILL[task['scratch']]
+    if task['scratch_spill'] == 'task_dir':
+        kinds = kinds[:1]
+
+    size = SCRATCH_SIZE if task['scratch_size'] is None else task['scratch_size']
+
+    with SCRATCH_LOCK:
+        for kind in kinds:
+            if scratch_full(kind,size):
+                info("Scratch [{}] is full - spilling task [{}]".format(kind,task['name']))
+                continue
+
+            path = "{}/{}/{}/{}".format(SCRATCH[kind]['root'],flow['name'],os.path.basename(task['stage_dir']),task['name'])
+            os.makedirs(path)
+            SCRATCH[kind]['live'][path]  = size
+            SCRATCH[kind]['reserved']   += size
+            return path
+
+    return None
+
+def scratch_options(name,opts):
+    '''
+    Check and convert the scratch options of a stage or task (in place)
+    Called for a whole stage before any of its tasks start
+    '''
+    if opts.get('scratch') not in [None] + sorted(SCRATCH):
+        sys.exit("ERROR: [{}] scratch must be one of {} - not [{}]".format(name,sorted(SCRATCH),opts['scratch']))
+    if opts.get('scratch_spill') not in (None,'next','task_dir'):
+        sys.exit("ERROR: [{}] scratch_spill must be next or task_dir - not [{}]".format(name,opts['scratch_spill']))
+    if opts.get('scratch_size') is not None:
+        opts['scratch_size'] = size_parse(opts['scratch_size'])
+
+def scratch_copy_back(scratch_dir,task_dir):
+    '''
+    Copy a scratch directory back to its task_dir then remove it
+    Runs in BG_POOL
+    '''
+    try:
+        shutil.copytree(scratch_dir,task_dir,symlinks=True,dirs_exist_ok=True)
+    finally:
+        shutil.rmtree(scratch_dir,ignore_errors=True)
+        with SCRATCH_LOCK:
+            for kind in SCRATCH:
+                SCRATCH[kind]['reserved'] -= SCRATCH[kind]['live'].pop(scratch_dir,0)
+
+def scratch_cleanup():
+    '''
+    Remove the scratch roots once everything has been copied back
+    '''
+    for kind in SCRATCH:
+        if SCRATCH[kind].get('root'):
+            shutil.rmtree(SCRATCH[kind]['root'],ignore_errors=True)
+
+def bg_submit(flow,task_dir,reason,fn,*args):
+    '''
+    Run fn in the background pool - bg_drain() collects the result
+    If fn raises the task FAILs with reason (None only warns)
+    '''
+    flow['bg_jobs'].append((task_dir,reason,BG_POOL.submit(fn,*args)))
+
+def bg_drain(flow,proc_results):
+    '''
+    Wait for a flow's background work
+    Failures are added to the task's result
+    '''
+    if flow['bg_jobs']:
+        info("Waiting for [{}] background job(s) to finish".format(len(flow['bg_jobs'])))
+
+    for (task_dir,reason,future) in flow['bg_jobs']:
+        try:
+            future.result()
+        except Exception as e:
+            if reason:
+                info("** FAIL ** Background job for [{}] : {}".format(task_dir,e))
+                result_set(flow,proc_results,task_dir,"FAIL: {} ({})".format(reason,e))
+            else:
+                info("WARNING: Background job for [{}] : {}".format(task_dir,e))
+
+    flow['bg_jobs'] = []
+
 def init():
     '''
     Initialize some globals
     '''
     global PATHS
     global OPTS
+    global SCHEDULER
+    global BG_POOL
+    global TIMERS
 
     PATHS['BIN_DIR']        = os.path.dirname(os.path.realpath(__file__))
     PATHS['TOOL_DIR']       = os.path.dirname(PATHS['BIN_DIR'])
@@ -153,32 +742,32 @@ def init():
     # Extend PYTHONPATH to include the root of the tool directory
     sys.path.append(PATHS['TOOL_DIR'])
 
-    # No --flow_file provided on CLI
-    # Let's try to resolve things before we error out
-    if not OPTS['flow_file']:
-        OPTS['flow_file'] = resolve_flow_file()
+    # Worker slots shared by all flows
+    SCHEDULER = Scheduler(OPTS['jobs'])
 
-    if not OPTS['flow_file']:
-        sys.exit("ERROR: No flow file (i.e. --flow_file) and unable to resolve based on project,branch,flow options")
+    # 1 thread for all timeouts
+    TIMERS = Timers()
+
+    # Changed files - select tasks affected by them
+    changes_init()
+
+    # Scratch copy-back happens in the background while other tasks run
+    BG_POOL = ThreadPoolExecutor(max_workers=OPTS['copy_workers'])
+    scratch_init()
 
     info("Establishing interrupt handler")
     signal.signal(signal.SIGINT, sig_handler)
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGHUP, sig_handler)
 
-def resolve_flow_file():
+def resolve_flow_file(project,branch,flow):
     '''
     Resolve a flow file
     See if we can resolve the file based on project,branch,flow
     '''
 
-    global OPTS
-    
     from config.config import DATA
 
-    project     = OPTS['project']
-    branch      = OPTS['branch']
-    flow        = OPTS['flow']
     flow_file   = None
 
     DATA = [x for x in DATA if x['project'].search(project)]
@@ -190,203 +779,268 @@ def resolve_flow_file():
 
     return flow_file 
 
+def flow_spec(spec):
+    '''
+    Split a flow spec into (flow,weight,priority)
+        <flow>[@<weight>[,<priority>]]
+    '''
+    flow,_,share     = spec.partition('@')
+    weight,_,prio    = share.partition(',')
+    weight           = float(weight) if weight else 1.0
+    prio             = int(prio) if prio else 0
+
+    if weight <= 0:
+        sys.exit("ERROR: Flow [{}] weight must be greater than 0".format(spec))
+
+    return (flow,weight,prio)
+
+def flows_init():
+    '''
+    Build the list of flows to run
+      --flow_file <file>                 (repeatable)
+      --flows <project>/<branch>/<flow>  (repeatable) Resolved through config.config
+      -p,-b,-f                           When nothing else is provided
+
+    Each flow gets its own results root.  A single flow keeps
+    <LAUNCH_DIR>/results, multiple flows use <LAUNCH_DIR>/results/<flow_name>
+    '''
+    global FLOWS
+
+    specs = []
+
+    for spec in OPTS['flow_file'] or []:
+        specs.append(flow_spec(spec))
+
+    for spec in OPTS['flows'] or []:
+        (pbf,weight,prio) = flow_spec(spec)
+        fields = pbf.split('/')
+        if len(fields) != 3:
+            sys.exit("ERROR: Flow [{}] is not of the form <project>/<branch>/<flow>".format(spec))
+        flow_file = resolve_flow_file(*fields)
+        if not flow_file:
+            sys.exit("ERROR: Unable to resolve flow file for [{}]".format(pbf))
+        specs.append((flow_file,weight,prio))
+
+    # No --flow_file provided on CLI
+    # Let's try to resolve things before we error out
+    if not specs:
+        flow_file = resolve_flow_file(OPTS['project'],OPTS['branch'],OPTS['flow'])
+        if flow_file:
+            specs.append((flow_file,1.0,0))
+
+    if not specs:
+        sys.exit("ERROR: No flow file (i.e. --flow_file) and unable to resolve based on project,branch,flow options")
+
+    for (flow_file,weight,prio) in specs:
+
+        # Flow names must be unique - they name the results root
+        name  = re.sub(r'\.json$','',os.path.basename(flow_file))
+        names = [x['name'] for x in FLOWS]
+        uniq  = name
+        while uniq in names:
+            uniq = "{}-{}".format(name,len(names))
+            names.append(uniq)
+
+        paths = dict(PATHS)
+        if len(specs) > 1:
+            paths['RESULTS_DIR'] = "{}/{}".format(PATHS['RESULTS_DIR'],uniq)
+            paths['OUTPUT_DIR']  = "{}/output".format(paths['RESULTS_DIR'])
+
+        FLOWS.append({
+            'name'          : uniq,
+            'flow_file'     : flow_file,
+            'weight'        : weight,
+            'priority'      : prio,
+            'PATHS'         : paths,
+            'tasks'         : {},       # pid -> Task of running tasks
+            'done'          : deque(),  # Exited tasks waiting to be processed - filled by procs_reap()
+            'streams'       : set(),    # Running tasks with a stream partner
+            'results'       : {},       # task_dir -> result for the whole flow
+            'results_fh'    : None,
+            'stage_failed'  : False,    # A task of the current stage FAILed
+            'stage_timer'   : None,
+            'stage_timeout' : False,
+            'generic_error' : False,
+            'bg_jobs'       : [],       # (task_dir,future) of background work
+            'affected'      : None,     # <stage>/<task> keys to run, None for all
+            'exit_code'     : None,
+        })
+
+    return FLOWS
+
+def prefix(msg):
+    # Tell interleaved flows apart
+    name = current_thread().name
+    if len(FLOWS) > 1 and name in [x['name'] for x in FLOWS]:
+        msg = "[{}] {}".format(name,msg)
+    return msg
+
 def div(msg=""):
     msg = "----- {}".format(msg)
-    print(msg)    
+    print(prefix(msg))    
 
 def info(msg):
     #msg = "{} : {}".format(ctime(),msg)
-    msg = "INFO : {}".format(msg)
+    msg = "INFO : {}".format(prefix(msg))
     print(msg)    
 
 def banner(msg,char='='):
     print('{}'.format(char)*40)
-    print(msg)
+    print(prefix(msg))
     print('{}'.format(char)*40)
 
-def wait_for_procs(kill_on_fail=False):
+def result_set(flow,proc_results,task_dir,status):
     '''
-    Wait for Proc objects to finish.
-    Optionally KILL remaining procs if 1 fails.
+    Record the result of a task
+    Results are streamed to <RESULTS_DIR>/proc_results.stream as they happen (last line wins)
     '''
+    proc_results[task_dir]    = status
+    flow['results'][task_dir] = status
 
-    global TASKS
-    global STAGE_TIMEOUT
-    global GENERAL_ERROR
+    # A timed out task doesn't stop the stage - every other FAIL does
+    if status.startswith("FAIL") and status != TIMEOUT_FAIL:
+        flow['stage_failed'] = True
 
-    proc_results = {}
+    flow['results_fh'].write("{}\t{}\n".format(task_dir,status))
 
-    info("Waiting for proc(s) to finish")
+def procs_reap():
+    '''
+    Move exited tasks to their flow's done queue.
+    waitid(WNOWAIT) names an exited child without reaping it and Popen.poll()
+    then reaps it - finding finished tasks doesn't mean polling every one.
+    Nothing else may poll()/wait() a task or waitid() never reports it.
+    Returns False when a child we don't know about exited (caller has to poll)
+    '''
+    with REAP_LOCK:
+        while True:
+            try:
+                child = os.waitid(os.P_ALL,0,os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            except ChildProcessError:
+                return True
+
+            if child is None:
+                return True
+
+            entry = RUNNING.pop(child.si_pid,None)
+            if entry is None:
+                return False
+
+            (flow,task) = entry
+            task.p.poll()
+            flow['done'].append(task)
+
+def procs_poll(flow,proc_results,kill_on_fail=False):
+    '''
+    Process the running tasks of a flow once.
+    Finished tasks are removed and their result added to proc_results.
+    '''
 
     # Helper functions
-    def done(p):
-        return p.poll() is not None
-    def success(p):
-        return p.returncode == 0
+    def running(task):
+        return task.p.returncode is None and not task.killed
 
-    
-    while True:
+    if not procs_reap():
+        # Fall back to polling our own tasks
+        with REAP_LOCK:
+            for task in list(flow['tasks'].values()):
+                if task.p.poll() is not None and RUNNING.pop(task.p.pid,None):
+                    flow['done'].append(task)
 
-        for task in TASKS:
-            
-            # Get the actual process opened by Popen(...
-            p = task.p
-            
-            if STAGE_TIMEOUT or GENERIC_ERROR:
-
-                # If the process isn't done - kill it and provide a reason
-                if not done(p):
-                    info("** KILL ** Task [{}]".format(task['name_uniq']))
-                    proc_results[task.task_dir] = "FAIL: Killed due to a STAGE_TIMEOUT or GENERIC_ERROR"
-                    task.kill()
-                    sleep(1)
-
-                elif 'FAIL' in proc_results.values():
-                    # Any current failures in proc_results
-
-                    if kill_on_fail: # Stage was configured to kill remaining tasks on failures
-
-                        if 'FAIL' not in proc_results[task.task_dir]:
-                            info("** KILL ** Task [{}]".format(task['name_uniq']))
-                            proc_results[task.task_dir] = "FAIL: Killed because another task failed"
-                            task.kill()
-
-            if done(p): # Process Done
-
-                # Turn off the timer if there is one
-                # We don't want it to timeout accidentally
-                task.done()
-
-                # Flush the output file
-                task.log_fh.flush()
-                
-                # Remove the ref from the list
-                TASKS.remove(task)
-                
-                if success(p):
-                    info("** PASS ** Task [{}]".format(task['name_uniq']))
-                    proc_results[task.task_dir] = "PASS"
-                else:
-
-                    # Task timeouts provide their own reason
-                    if task.fail_reason:
-                        proc_results[task.task_dir] = task.fail_reason
-
-                    # Task did not pass
-                    # It may be marked with another state
-                    # Only mark FAIL if it didn't finish for some other reason
-                    if task.task_dir not in proc_results: # May have been marked as KILLED
-                        info("** FAIL ** Task [{}]".format(task['name_uniq']))
-                        proc_results[task.task_dir] = "FAIL"
-                    
-        if TASKS:            
-            sleep(5)
+    if flow['stage_timeout'] or flow['generic_error'] or GENERIC_ERROR:
+
+        # If the process isn't done - kill it and provide a reason
+        for task in [x for x in flow['tasks'].values() if running(x)]:
+            info("** KILL ** Task [{}]".format(task['name_uniq']))
+            result_set(flow,proc_results,task.task_dir,"FAIL: Killed due to a STAGE_TIMEOUT or GENERIC_ERROR")
+            task.kill()
+
+    elif kill_on_fail and flow['stage_failed']:
+        # Stage was configured to kill remaining tasks on failures
+
+        for task in [x for x in flow['tasks'].values() if running(x)]:
+            if 'FAIL' not in proc_results.get(task.task_dir,''):
+                info("** KILL ** Task [{}]".format(task['name_uniq']))
+                result_set(flow,proc_results,task.task_dir,"FAIL: Killed because another task failed")
+                task.kill()
+
+    # Streamed tasks follow their partner
+    for task in list(flow['streams']):
+        if task.p.returncode is None:
+            stream_poll(flow,task,proc_results)
+
+    while flow['done']: # Process Done
+
+        task = flow['done'].popleft()
+        p    = task.p
+
+        # Turn off the timer if there is one
+        # We don't want it to timeout accidentally
+        task.done()
+
+        # Results are copied back from scratch while the next tasks run
+        if task.scratch_dir:
+            bg_submit(flow,task.task_dir,"Scratch copy-back failed",scratch_copy_back,task.scratch_dir,task.task_dir)
+
+        # Index error/warning lines for flowb triage
+        bg_submit(flow,task.task_dir,None,log_index,task.log_file,"{}/log_index.json".format(task.task_dir))
+        
+        # Remove the ref from the running set
+        # Give the worker slot back
+        del flow['tasks'][p.pid]
+        flow['streams'].discard(task)
+        SCHEDULER.release(flow)
+        
+        if p.returncode == 0:
+            info("** PASS ** Task [{}]".format(task['name_uniq']))
+            result_set(flow,proc_results,task.task_dir,"PASS")
+        elif task.stream_sigpipe():
+            info("** PASS ** Task [{}] (SIGPIPE)".format(task['name_uniq']))
+            result_set(flow,proc_results,task.task_dir,"PASS: Stream consumer [{}] finished before reading everything (SIGPIPE)".format(task.stream_consumer.name))
         else:
-            break
-            
-    return proc_results
 
-def wait_for_procs_orig(kill_on_fail=False):
+            # Task timeouts provide their own reason
+            if task.fail_reason:
+                result_set(flow,proc_results,task.task_dir,task.fail_reason)
+
+            # The kernel killed the task for going over memory_max
+            if task.task_dir not in proc_results and task.oom_killed():
+                info("** OOM ** Task [{}]".format(task['name_uniq']))
+                result_set(flow,proc_results,task.task_dir,"FAIL: Task OOM killed (memory_max={})".format(task.memory_max))
+
+            # Task did not pass
+            # It may be marked with another state
+            # Only mark FAIL if it didn't finish for some other reason
+            if task.task_dir not in proc_results: # May have been marked as KILLED
+                info("** FAIL ** Task [{}]".format(task['name_uniq']))
+                result_set(flow,proc_results,task.task_dir,"FAIL")
+
+def wait_for_procs(flow,kill_on_fail=False,proc_results=None):
     '''
     Wait for Proc objects to finish.
     Optionally KILL remaining procs if 1 fails.
     '''
 
-    global TASKS
-    global STAGE_TIMEOUT
-    global GENERAL_ERROR
-
-    proc_results = {}
+    if proc_results is None:
+        proc_results = {}
 
     info("Waiting for proc(s) to finish")
 
-    # Helper functions
-    def done(p):
-        return p.poll() is not None
-    def success(p):
-        return p.returncode == 0
-
-    
     while True:
 
-        for task in TASKS:
-            
-            # Get the actual process opened by Popen(...
-            p = task.p
-
-            if done(p): # Process Done
-
-                # Turn off the timer if there is one
-                # We don't want it to timeout accidentally
-                task.done()
-
-                # Flush the output file
-                task.log_fh.flush()
-                
-                # Remove the ref from the list
-                TASKS.remove(task)
-                
-                if success(p):
-                    print(STAGE_TIMEOUT)
-                    info("** PASS ** Task [{}]".format(task['name_uniq']))
-                    proc_results[task.task_dir] = "PASS"
-                else:
-
-                    # Task timeouts provide their own reason
-                    if task.fail_reason:
-                        proc_results[task.task_dir] = task.fail_reason
-
-                    # Task did not pass
-                    # It may be marked with another state
-                    # Only mark FAIL if it didn't finish for some other reason
-                    if task.task_dir not in proc_results: # May have been marked as KILLED
-                        info("** FAIL ** Task [{}]".format(task['name_uniq']))
-                        proc_results[task.task_dir] = "FAIL"
+        procs_poll(flow,proc_results,kill_on_fail)
                     
-        if TASKS:            
-            # The stage may have timed out
-            # Kill all tasks currently running
-            if STAGE_TIMEOUT or GENERIC_ERROR:
-                print("Hit a stage timeout")
-                for task in TASKS:
-                    p = task.p # Get the process (Popen(...))
-                    # If the process isn't done - kill it and provide a reason
-                    if not done(p):
-                        info("** KILL ** Task [{}]".format(task['name_uniq']))
-                        p.kill()
-                        proc_results[task.task_dir] = "FAIL: Killed due to a STAGE_TIMEOUT or GENERIC_ERROR"
-                        task.done() # task cleanup - timer cancel
-                sleep(5)
-
-            elif 'FAIL' in proc_results.values():
-                # Any current failures in proc_results
-
-                if kill_on_fail: # Stage was configured to kill remaining tasks on failures
-
-                    for task in TASKS:
-                        p = task.p
-                        if not done(p):
-                            info("** KILL ** Task [{}]".format(task['name_uniq']))
-                            p.kill()
-                            proc_results[task.task_dir] = "FAIL: Killed because another task failed"
-                            task.done() # task cleanup - timer cancel
-                    sleep(5)
-            else:
-                # Waiting for tasks to complete
-                sleep(10) 
+        if flow['tasks']:            
+            sleep(POLL_SEC)
         else:
-            # No more tasks remaining
-            # Break from the while loop
             break
             
     return proc_results
 
 
-def task_init(stage,task):
+def task_init(flow,stage,task):
     '''
     Initialize a task
     '''
-    global PATHS
 
     # DEFAULTS
     task_ref = {
@@ -401,7 +1055,20 @@ def task_init(stage,task):
         'delay_end_sec'    : 0,
         'task_src'         : None,
         'command'          : None,
-        'PATHS'            : PATHS,
+        'cpu_quota'        : stage['cpu_quota'],
+        'memory_max'       : stage['memory_max'],
+        'io_weight'        : stage['io_weight'],
+        'cgroup'           : None,
+        'scratch'          : stage['scratch'],
+        'scratch_spill'    : stage['scratch_spill'],
+        'scratch_size'     : stage['scratch_size'],
+        'scratch_dir'      : None,
+        'inputs'           : [],
+        'depends'          : [],
+        'stream_from'      : None,
+        'stream_in'        : None,
+        'stream_out'       : None,
+        'PATHS'            : flow['PATHS'],
     }
     
     # Overrides
@@ -418,7 +1085,85 @@ def task_init(stage,task):
 
     return task_ref
 
-def stage_init(stage):
+def task_launch(flow,task):
+    '''
+    Launch an initialized task
+    Returns the Task object
+    '''
+    dir_create(task['task_dir'])
+
+    # Isolate the task in its own cgroup if it has limits
+    task['cgroup'] = cgroup_create(task)
+
+    # Run from scratch - results are copied back to task_dir when done
+    task['scratch_dir'] = scratch_create(flow,task)
+    run_dir             = task['scratch_dir'] or task['task_dir']
+    
+    # Dump config file to task directory
+    with open(task['config_file'],'w') as outfile:
+        json.dump(task,outfile,indent=4,sort_keys=True)       
+    info("Task config file [{}] written".format(task['config_file']))
+
+    # Execute the task - task itself should be executable
+    command = []
+
+    # Start up delay
+    if task['delay_begin_sec']:
+        command.append("sleep {}".format(task['delay_begin_sec']))
+
+    # The actual script to run
+    if task['task_src']:
+        command.append("{} {}".format(task['task_src'],task['config_file']))
+    elif task['command']:
+        command.append("{}".format(task['command']))
+    else:
+        flow['generic_error'] = True
+        print("ERROR: Task {} had neither 'task' or 'command' defined".format(task['name']))            
+    
+    # Start up delay
+    if task['delay_end_sec']:
+        command.append("sleep {}".format(task['delay_end_sec']))
+
+              
+    #command = [task['task_src'],task['config_file']]
+    command = ";".join(command)
+    launch  = command
+
+    # The shell moves itself into the cgroup before anything runs
+    #   All children started by the task end up in there as well
+    #   The command gets lines of its own - a trailing &, ; or # comment stays valid
+    if task['cgroup']:
+        launch = "echo $$ > {}/cgroup.procs && {{\n{}\n}}".format(task['cgroup'],command)
+
+    # Streamed tasks find their pipe in the environment
+    env = flow['env']
+    if task['stream_in'] or task['stream_out']:
+        env = dict(env)
+        env['FLOWB_STREAM_IN']  = task['stream_in'] or ''
+        env['FLOWB_STREAM_OUT'] = task['stream_out'] or ''
+
+    # Launch inside the task directory
+    #   Also give the procedure a log_file to write to
+    #   Only the task needs the log open - don't hold a descriptor per task
+    with open(task['log_file'],'w') as task_log_fh:
+        p = subprocess.Popen(launch,stdout=task_log_fh,stderr=task_log_fh,shell=True,cwd=run_dir,env=env,
+                             start_new_session=bool(task['stream_in'] or task['stream_out']))
+
+    # Create PROC object
+    # Add to the flow's running set - used in wait_for_procs()
+    proc_ref = Task(p,task)
+    with REAP_LOCK:
+        flow['tasks'][p.pid] = proc_ref
+        RUNNING[p.pid]       = (flow,proc_ref)
+    if proc_ref.stream_in or proc_ref.stream_out:
+        flow['streams'].add(proc_ref)
+    
+    info("Command [{}]".format(command))
+    info("Launched task [{}] in directory [{}]".format(proc_ref['name_uniq'],run_dir))
+
+    return proc_ref
+
+def stage_init(flow,stage):
     ''' 
     Initialize a stage
     '''
@@ -431,40 +1176,46 @@ def stage_init(stage):
         'task_continue_on_fail' : False,
         'stage_continue_on_fail': False,
         'timeout_sec'           : 0,
+        'cpu_quota'             : None,     # CPUs each task may use (cgroup v2 cpu.max)
+        'memory_max'            : None,     # Memory limit for each task (cgroup v2 memory.max)
+        'io_weight'             : None,     # IO weight for each task 1-10000 (cgroup v2 io.weight)
+        'scratch'               : None,     # Run tasks in a tmpfs|local scratch directory
+        'scratch_spill'         : None,     # Where to go when scratch is full - next (default) or task_dir
+        'scratch_size'          : None,     # Scratch space each task reserves against --scratch_budget
     }
     
     # Override any defaults 
     for opt in stage:
         stage_ref[opt] = stage[opt]
 
+    # Bad limits/scratch options fail the stage before any task starts
+    cgroup_limits("Stage {}".format(stage_ref['name']),stage_ref)
+    scratch_options("Stage {}".format(stage_ref['name']),stage_ref)
+    for task in stage_ref['tasks']:
+        cgroup_limits("Task {}".format(task['name']),task)
+        scratch_options("Task {}".format(task['name']),task)
+
     # More configuration
-    stage_ref['stage_dir']          = "{}/{}".format(PATHS['RESULTS_DIR'],stage['name'])
+    stage_ref['stage_dir']          = "{}/{}".format(flow['PATHS']['RESULTS_DIR'],stage['name'])
     stage_ref['config_file']        = "{}/config.json".format(stage_ref['stage_dir'])
     stage_ref['stage_output_dir']   = "{}/output".format(stage_ref['stage_dir'])
 
     return stage_ref
 
-def stage_run(stage):
+def stage_run(flow,stage):
     '''
     Run a particular stage
     '''
 
-    global TASKS
     global OPTS
-    global STAGE_TIMEOUT
-    global GENERIC_ERROR
-
-    def done(p):
-        return p.poll() is not None
-    def success(p):
-        return p.returncode == 0
 
     banner("Stage [{}] START".format(stage['name']))
     pprint(stage)
     div()
 
     # Stage results (PASS|FAIL|KILLED) that get returned
-    stage_proc_results = {}
+    stage_proc_results   = {}
+    flow['stage_failed'] = False
 
     # Create the stage directory
     dir_create(stage['stage_dir'])
@@ -482,82 +1233,62 @@ def stage_run(stage):
     if OPTS['tasks']:
         tasks = [x for x in tasks if x['name'] in OPTS['tasks']]
 
+    # Skip tasks not affected by the changes
+    #   Streamed consumers keep the key of the stage they were declared in
+    if flow['affected'] is not None:
+        def key(task):
+            return "{}/{}".format(task.get('stream_stage',stage['name']),task['name'])
+        for task in tasks:
+            if key(task) not in flow['affected']:
+                info("** SKIPPED ** Task [{}] not affected by changes".format(task['name']))
+                result_set(flow,stage_proc_results,"{}/{}".format(stage['stage_dir'],task['name']),"SKIPPED")
+        tasks = [x for x in tasks if key(x) in flow['affected']]
+
     # See if we need to start a timer
     if stage['timeout_sec']:
         info("Starting stage timer for [{}] seconds".format(stage['timeout_sec']))
-        stage_timer_start(stage['timeout_sec'])
+        stage_timer_start(flow,stage['timeout_sec'])
 
-    # Cycle through the tasks
-    for task in tasks:
+    # When running in parallel we decide whether a failure on 1 task kills the remaining
+    kill_on_fail = not stage['task_continue_on_fail']
 
-        if STAGE_TIMEOUT:
+    # Cycle through the tasks
+    #   Streamed consumers are grouped with (and launched alongside) their producer
+    for group in stream_groups(flow,stage,tasks,stage_proc_results):
+
+        # Wait for worker slot(s) - keep reaping our own tasks meanwhile
+        #   The flow stays queued between tries so a slot freed meanwhile is kept for it
+        granted = False
+        try:
+            while not granted and not (flow['stage_timeout'] or flow['generic_error'] or GENERIC_ERROR):
+                granted = SCHEDULER.acquire(flow,n=len(group),timeout=SLOT_SEC)
+                if not granted:
+                    procs_poll(flow,stage_proc_results,kill_on_fail)
+        finally:
+            SCHEDULER.cancel(flow)
+
+        if flow['stage_timeout'] or flow['generic_error'] or GENERIC_ERROR:
+            if granted:
+                SCHEDULER.release(flow,n=len(group))
             break
         
         div() 
 
-        # Initialize the task
-        task = task_init(stage,task)
-        dir_create(task['task_dir'])
-        
-        # Dump config file to task directory
-        with open(task['config_file'],'w') as outfile:
-            json.dump(task,outfile,indent=4,sort_keys=True)       
-        info("Task config file [{}] written".format(task['config_file']))
-
-        # Execute the task - task itself should be executable
-        command = []
-
-        # Start up delay
-        if task['delay_begin_sec']:
-            command.append("sleep {}".format(task['delay_begin_sec']))
-
-        # The actual script to run
-        if task['task_src']:
-            command.append("{} {}".format(task['task_src'],task['config_file']))
-        elif task['command']:
-            command.append("{}".format(task['command']))
-        else:
-            GENERIC_ERROR = True
-            print("ERROR: Task {} had neither 'task' or 'command' defined".format(task['name']))            
-        
-        # Start up delay
-        if task['delay_end_sec']:
-            command.append("sleep {}".format(task['delay_end_sec']))
-
-                  
-        #command = [task['task_src'],task['config_file']]
-        command = ";".join(command)
-
-        # Launch inside the task directory
-        #   Also give the procedure a log_file to write to
-        os.chdir(task['task_dir'])
-        task_log_fh = open(task['log_file'],'w')
-        p = subprocess.Popen(command,stdout=task_log_fh,stderr=task_log_fh,shell=True)
-        task['log_fh'] = task_log_fh
-        os.chdir(PATHS['RESULTS_DIR'])
-
-        # Create PROC object
-        # Add to global PROC list - used in wait_for_procs()
-        proc_ref = Task(p,**task)
-        TASKS.append(proc_ref)
-        
-        info("Command [{}]".format(command))
-        info("Launched task [{}] in directory [{}]".format(proc_ref['name_uniq'],task['task_dir']))
+        # Initialize the tasks - streamed tasks need their pipes before launch
+        group = [task_init(flow,stage,task) for task in group]
+        stream_init(flow,stage,group)
+
+        stream_link([task_launch(flow,task) for task in group])
 
         # Serial - Process PROC list immediately after adding
         if stage['serial'] == True:
            
             # Wait for procs, collect results
-            results = wait_for_procs()
-
-            # Add results to final tally
-            for proc_name in results:
-                stage_proc_results[proc_name] = results[proc_name]
-        
+            wait_for_procs(flow,proc_results=stage_proc_results)
 
             # When running in serial we decide whether a failure allows us to continue
             if not stage['task_continue_on_fail']:
-                if 'FAIL' in stage_proc_results.values():
+                if flow['stage_failed']:
                     info("Configured to NOT continue on FAIL")
                     break
     
@@ -566,19 +1297,308 @@ def stage_run(stage):
         
         div()
 
-        # When running in parallel we decide whether a failure on 1 task kills the remaining
-        kill_on_fail = not stage['task_continue_on_fail']
-        results = wait_for_procs(kill_on_fail=kill_on_fail)
-
-        # Add results to final tally
-        for proc_name in results:
-            stage_proc_results[proc_name] = results[proc_name]
+        wait_for_procs(flow,kill_on_fail=kill_on_fail,proc_results=stage_proc_results)
 
     # There might not be any timer - but call it just in case
-    stage_timer_stop()
+    stage_timer_stop(flow)
+
+    # Next stage may read this stage's task directories
+    bg_drain(flow,stage_proc_results)
 
     return stage_proc_results
 
+def flow_streams(stages):
+    '''
+    Resolve stream edges and move each streamed consumer into its
+    producer's stage, right after the producer, so both start together.
+    stream_from - <stage>/<task> or <task> (same stage first)
+    A producer streams to 1 consumer, consumers can be producers (chains)
+    '''
+    tasks = [(stage,task) for stage in stages for task in stage['tasks']]
+    links = []
+
+    for (stage,task) in tasks:
+        src = task.get('stream_from')
+        if not src:
+            continue
+
+        if '/' in src:
+            (stage_name,_,name) = src.partition('/')
+            found = [t for (st,t) in tasks if st['name'] == stage_name and t['name'] == name]
+        else:
+            found = [t for (st,t) in tasks if st is stage and t['name'] == src] or [t for (st,t) in tasks if t['name'] == src]
+
+        if not found:
+            sys.exit("ERROR: Task [{}] streams from unknown task [{}]".format(task['name'],src))
+        if [c for (c,p) in links if p is found[0]]:
+            sys.exit("ERROR: Task [{}] already streams to another consumer".format(src))
+
+        links.append((task,found[0]))
+
+    def where(task):
+        for stage in stages:
+            for (i,t) in enumerate(stage['tasks']):
+                if t is task:
+                    return (stage,i)
+
+    # Chains may need a few passes to settle
+    for attempt in range(len(links) + 1):
+        moved = False
+        for (consumer,producer) in links:
+            (src,i) = where(consumer)
+            (dst,j) = where(producer)
+            if src is not dst or i < j:
+                consumer.setdefault('stream_stage',src['name'])
+                consumer['stream_from'] = producer['name']
+                del src['tasks'][i]
+                dst['tasks'].insert(where(producer)[1] + 1,consumer)
+                moved = True
+        if not moved:
+            break
+    else:
+        sys.exit("ERROR: Stream edges form a cycle")
+
+    for (consumer,producer) in links:
+        consumer['stream_from'] = producer['name']
+
+def stream_groups(flow,stage,tasks,proc_results):
+    '''
+    Split a stage's tasks into launch groups - a producer and its streamed consumer(s)
+    A consumer whose producer isn't running (i.e. -t) is SKIPPED - it would wait forever
+    '''
+    groups = []
+    group  = {}
+    for task in tasks:
+        src = task.get('stream_from')
+        if not src:
+            group[task['name']] = [task]
+            groups.append(group[task['name']])
+        elif src in group:
+            group[src].append(task)
+            group[task['name']] = group[src]
+        else:
+            info("** SKIPPED ** Task [{}] stream producer [{}] not run".format(task['name'],src))
+            result_set(flow,proc_results,"{}/{}".format(stage['stage_dir'],task['name']),"SKIPPED: Stream producer [{}] not run".format(src))
+    return groups
+
+def stream_init(flow,stage,group):
+    '''
+    Create the named pipe between each producer and consumer in a launch group
+    Pipes live in the local scratch area - not the (possibly network) task_dir
+    '''
+    names = dict([(task['name'],task) for task in group])
+    for consumer in group:
+        if not consumer['stream_from']:
+            continue
+        producer = names[consumer['stream_from']]
+        pipe_dir = "{}/{}/{}".format(SCRATCH['local']['root'],flow['name'],stage['name'])
+        pipe     = "{}/{}.stream".format(pipe_dir,producer['name'])
+        if not os.path.exists(pipe_dir):
+            os.makedirs(pipe_dir)
+        if os.path.exists(pipe):
+            os.unlink(pipe)
+        os.mkfifo(pipe)
+        producer['stream_out'] = pipe
+        consumer['stream_in']  = pipe
+        info("Stream [{}] -> [{}] via [{}]".format(producer['name'],consumer['name'],pipe))
+
+def stream_link(procs):
+    '''
+    Point streamed Task objects at each other
+    '''
+    names = dict([(proc.name,proc) for proc in procs])
+    for proc in procs:
+        if proc.stream_from:
+            proc.stream_producer = names[proc.stream_from]
+            names[proc.stream_from].stream_consumer = proc
+
+def stream_poll(flow,task,proc_results):
+    '''
+    Propagate the state of a running task's stream partner
+      - Partner FAILed                      Kill the task
+      - Producer PASSed                     Wake a consumer still blocked opening the pipe (it reads EOF)
+      - Consumer PASSed                     Wake a producer still blocked opening the pipe (it gets EPIPE/SIGPIPE)
+    '''
+    for (partner,role) in ((task.stream_producer,'producer'),(task.stream_consumer,'consumer')):
+
+        if not partner or partner.p.returncode is None:
+            continue
+
+        if partner.p.returncode != 0:
+            if task.task_dir not in proc_results:
+                info("** KILL ** Task [{}] stream {} [{}] failed".format(task.name_uniq,role,partner.name_uniq))
+                result_set(flow,proc_results,task.task_dir,"FAIL: Killed because stream {} [{}] failed".format(role,partner.name))
+                task.kill()
+        elif role == 'producer' and not task.stream_eof:
+            try:
+                # Only succeeds once the consumer has the pipe open for reading
+                os.close(os.open(task.stream_in,os.O_WRONLY | os.O_NONBLOCK))
+                task.stream_eof = True
+            except OSError:
+                pass
+        elif role == 'consumer' and not task.stream_epipe:
+            try:
+                # An empty pipe reads EAGAIN while a writer has it open, EOF when none has yet
+                fd = os.open(task.stream_out,os.O_RDONLY | os.O_NONBLOCK)
+                try:
+                    task.stream_epipe = os.read(fd,1) != b''
+                except BlockingIOError:
+                    task.stream_epipe = True
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+def changes_init():
+    '''
+    Collect the changed files used to select tasks
+      --changed_since <rev>   Files changed between <rev> and the working tree (plus untracked files)
+      --changed_files <file>  Files listed 1 per line ('-' for stdin)
+    Paths are relative to the root of the repository
+    '''
+    global CHANGES
+
+    if not OPTS['changed_since'] and not OPTS['changed_files']:
+        return None
+
+    changes = set()
+
+    if OPTS['changed_since']:
+        git = ["git","-C",PATHS['LAUNCH_DIR']]
+        for cmd in (["diff","--name-only",OPTS['changed_since']],["ls-files","--others","--exclude-standard","--full-name"]):
+            try:
+                # diff --name-only is always relative to the top of the repo
+                out = subprocess.check_output(git + cmd,universal_newlines=True)
+            except (OSError,subprocess.CalledProcessError) as e:
+                sys.exit("ERROR: Unable to get changes since [{}] ({})".format(OPTS['changed_since'],e))
+            changes.update([x for x in out.splitlines() if x])
+
+    if OPTS['changed_files']:
+        fh = sys.stdin if OPTS['changed_files'] == '-' else open(OPTS['changed_files'],'r')
+        changes.update([re.sub(r'^\./','',x.strip()) for x in fh if x.strip()])
+        if fh is not sys.stdin:
+            fh.close()
+
+    info("[{}] changed file(s)".format(len(changes)))
+    CHANGES = changes
+    return CHANGES
+
+def glob_regex(glob):
+    '''
+    Convert a path glob to a compiled regex
+        **   Any number of directories
+        *    Anything but /
+        ?    Any character but /
+        [..] Character class
+    A trailing / matches everything below the directory
+    '''
+    if glob.endswith('/'):
+        glob += '**'
+
+    regex = ''
+    i     = 0
+    while i < len(glob):
+        if glob.startswith('**/',i):
+            regex += '(?:.*/)?'
+            i     += 3
+        elif glob.startswith('**',i):
+            regex += '.*'
+            i     += 2
+        elif glob[i] == '*':
+            regex += '[^/]*'
+            i     += 1
+        elif glob[i] == '?':
+            regex += '[^/]'
+            i     += 1
+        elif glob[i] == '[' and ']' in glob[i+1:]:
+            end    = glob.index(']',i+1)
+            regex += '[{}]'.format(glob[i+1:end].replace('!','^',1) if glob[i+1] == '!' else glob[i+1:end])
+            i      = end + 1
+        else:
+            regex += re.escape(glob[i])
+            i     += 1
+
+    return re.compile(regex + '$')
+
+def glob_index(tasks):
+    '''
+    Index the inputs globs of tasks by their literal directory prefix
+        {'src/foo' : [(regex,key),...]}
+    A changed file only has to be tested against the globs indexed
+    under 1 of its parent directories
+    '''
+    index = {}
+    for (key,task) in tasks:
+        for glob in task['inputs']:
+            glob   = re.sub(r'^\./','',glob)
+            prefix = []
+            for part in glob.split('/')[:-1]:
+                if re.search(r'[*?\[]',part):
+                    break
+                prefix.append(part)
+            index.setdefault('/'.join(prefix),[]).append((glob_regex(glob),key))
+    return index
+
+def glob_index_match(index,path):
+    '''
+    Keys of the tasks with a glob matching path
+    '''
+    keys  = set()
+    parts = path.split('/')
+    for i in range(len(parts)):
+        for (regex,key) in index.get('/'.join(parts[:i]),[]):
+            if key not in keys and regex.match(path):
+                keys.add(key)
+    return keys
+
+def flow_affected(stages):
+    '''
+    Keys (<stage>/<task>) of the tasks affected by CHANGES
+      - Tasks without inputs always run
+      - Tasks with an inputs glob matching a changed file
+      - Anything that depends on them (downstream)
+      - Both ends of a stream
+    Returns None when not selecting on changes
+    '''
+    if CHANGES is None:
+        return None
+
+    tasks = []
+    for stage in stages:
+        for task in stage['tasks']:
+            tasks.append(("{}/{}".format(stage['name'],task['name']),task))
+
+    # depends - <stage>/<task> or <task> (same stage, otherwise any stage)
+    keys       = set([k for (k,t) in tasks])
+    dependents = {}
+    for (key,task) in tasks:
+        stage_name = key.split('/')[0]
+        for dep in task.get('depends',[]) + ([task['stream_from']] if task.get('stream_from') else []):
+            if '/' not in dep:
+                same = "{}/{}".format(stage_name,dep)
+                dep  = same if same in keys else next((k for (k,t) in tasks if t['name'] == dep),dep)
+            dependents.setdefault(dep,[]).append(key)
+
+            # Streamed tasks have to run together - a consumer pulls in its producer
+            if task.get('stream_from'):
+                dependents.setdefault(key,[]).append(dep)
+
+    affected = set([k for (k,t) in tasks if not t.get('inputs')])
+    index    = glob_index([(k,t) for (k,t) in tasks if t.get('inputs')])
+    for path in CHANGES:
+        affected.update(glob_index_match(index,path))
+
+    # Walk downstream
+    todo = list(affected)
+    while todo:
+        for key in dependents.get(todo.pop(),[]):
+            if key not in affected:
+                affected.add(key)
+                todo.append(key)
+
+    info("Change aware - running [{}] of [{}] task(s)".format(len(affected),len(tasks)))
+    return affected
+
 def json_parse(f):
     '''
     Process a JSON file
@@ -614,42 +1634,41 @@ def json_parse(f):
     json_data = json.loads("".join(lines))
     return json_data
 
-def run(**kwargs):
+def flow_run(flow):
     '''
-    The main process that runs
-    Run all stages
+    Run all stages of a flow
     '''
-    global PATHS
-    global OPTS
-    global GENERIC_ERROR
 
     # Resulting exit code
     exit_code = 0
 
-    # Assign CLI options to OPT dict
-    for opt in kwargs:
-        OPTS[opt] = kwargs[opt]
-
-    # Initialize
-    banner("Init")
-    init()
+    paths = flow['PATHS']
 
     # Select config file
-    json_file = resolve_file(OPTS['flow_file'],dirs=[PATHS['FLOWS_DIR']],exts=['.json'])
-    json_parse(json_file)
+    json_file = resolve_file(flow['flow_file'],dirs=[PATHS['FLOWS_DIR']],exts=['.json'])
     info("Pipeline file [{}]".format(json_file))
     stages = json_parse(json_file)
 
+    # Which tasks are affected by the changes (whole flow - depends can cross stages)
+    flow['affected'] = flow_affected(stages)
+
+    # Streamed consumers run in their producer's stage
+    flow_streams(stages)
+
     # Create directories
-    dir_create(PATHS['RESULTS_DIR'])
-    dir_create(PATHS['OUTPUT_DIR'])
+    dir_create(paths['RESULTS_DIR'])
+    dir_create(paths['OUTPUT_DIR'])
     
     # Setup some environment variables that tasks can use
-    os.environ["FLOWB_RESULTS_DIR"] = PATHS['RESULTS_DIR']
-    os.environ["FLOWB_OUTPUT_DIR"] = PATHS['OUTPUT_DIR']
+    flow['env'] = dict(os.environ)
+    flow['env']["FLOWB_RESULTS_DIR"] = paths['RESULTS_DIR']
+    flow['env']["FLOWB_OUTPUT_DIR"]  = paths['OUTPUT_DIR']
+
+    # Results are streamed here as tasks finish
+    flow['results_fh'] = open("{}/proc_results.stream".format(paths['RESULTS_DIR']),'w',buffering=1)
 
     # Dump config file to results directory
-    results_config = "{}/config.json".format(PATHS['RESULTS_DIR'])
+    results_config = "{}/config.json".format(paths['RESULTS_DIR'])
     with open(results_config,'w') as outfile:
         json.dump(stages,outfile,indent=4,sort_keys=True)       
     
@@ -659,21 +1678,19 @@ def run(**kwargs):
         stages = [x for x in stages if x['name'] in OPTS['stages']]
 
     # Looping information
-    all_stage_results = {}
+    all_stage_results = flow['results']
     stage_dir_prev  = None
 
     # Walk the flow
     for stage in stages:
         
         # Initialize stage 
-        stage                   = stage_init(stage)
+        stage                   = stage_init(flow,stage)
         stage['stage_dir_prev'] = stage_dir_prev
 
         # Run
-        stage_results   = stage_run(stage)
-
-        for proc_name in stage_results:
-            all_stage_results[proc_name] = stage_results[proc_name]
+        #   Results are added to all_stage_results as they happen
+        stage_results   = stage_run(flow,stage)
             
         div()
         banner("Stage [{}] RESULTS".format(stage['name']))
@@ -690,8 +1707,8 @@ def run(**kwargs):
             if not stage['stage_continue_on_fail']:
                 break
 
-        if GENERIC_ERROR:
-            print("Breaking due to GENERIC_ERROR")
+        if flow['generic_error'] or GENERIC_ERROR:
+            print(prefix("Breaking due to GENERIC_ERROR"))
             break
 
         # Keep track of previous stage
@@ -704,12 +1721,394 @@ def run(**kwargs):
     banner("ALL STAGE RESULTS")
     pprint(all_stage_results)
         
-    results_file = "{}/proc_results.log".format(PATHS['RESULTS_DIR'])
+    results_file = "{}/proc_results.log".format(paths['RESULTS_DIR'])
     with open(results_file,'w') as fh:
         fh.write("{}".format(pformat(all_stage_results)))
 
+    # Run level index - lets flowb triage answer from 1 file
+    triage_index_write(paths['RESULTS_DIR'],all_stage_results)
+
+    flow['results_fh'].close()
+
+    flow['exit_code'] = exit_code
     return exit_code
 
+def flow_abort(flow):
+    '''
+    Clean up after a flow that died - kill its tasks and give back its worker slots
+    so the other flows keep going
+    '''
+    flow['generic_error'] = True
+    stage_timer_stop(flow)
+
+    for task in list(flow['tasks'].values()):
+        info("** KILL ** Task [{}]".format(task['name_uniq']))
+        task.kill()
+
+    SCHEDULER.drop(flow)
+
+    if flow['results_fh']:
+        flow['results_fh'].close()
+
+def flow_thread(flow):
+    '''
+    Run a flow - any error (sys.exit included) fails this flow only
+    '''
+    try:
+        return flow_run(flow)
+    except SystemExit as e:
+        info("{}".format(e.code) if isinstance(e.code,str) else "ERROR: Flow [{}] exited with [{}]".format(flow['name'],e.code))
+    except Exception:
+        info("ERROR: Flow [{}] failed\n{}".format(flow['name'],traceback.format_exc()))
+
+    flow_abort(flow)
+    flow['exit_code'] = 1
+    return flow['exit_code']
+
+def run(**kwargs):
+    '''
+    The main process that runs
+    '''
+    global PATHS
+    global OPTS
+
+    # Assign CLI options to OPT dict
+    for opt in kwargs:
+        OPTS[opt] = kwargs[opt]
+
+    # Initialize
+    banner("Init")
+    init()
+
+    # Scratch dirs live in /dev/shm - never leave them behind
+    try:
+        return run_flows()
+    finally:
+        BG_POOL.shutdown(wait=True,cancel_futures=True)
+        cgroup_cleanup()
+        scratch_cleanup()
+
+def run_flows():
+    '''
+    Run all flows - concurrently when there is more than 1
+    '''
+    flows = flows_init()
+
+    if len(flows) == 1:
+        return flow_thread(flows[0])
+
+    dir_create(PATHS['RESULTS_DIR'])
+
+    threads = []
+    for flow in flows:
+        info("Flow [{}] file [{}] weight={} priority={}".format(flow['name'],flow['flow_file'],flow['weight'],flow['priority']))
+        thread = Thread(target=flow_thread,args=[flow],name=flow['name'])
+        thread.start()
+        threads.append(thread)
+
+    # Join with a timeout so signals still reach sig_handler
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    # A flow that died without an exit code failed
+    flow_results = {}
+    for flow in flows:
+        flow_results[flow['name']] = 1 if flow['exit_code'] is None else flow['exit_code']
+
+    banner("ALL FLOW RESULTS")
+    pprint(flow_results)
+
+    results_file = "{}/flow_results.log".format(PATHS['RESULTS_DIR'])
+    with open(results_file,'w') as fh:
+        fh.write("{}".format(pformat(flow_results)))
+
+    return max(flow_results.values())
+
+def log_read(path):
+    '''
+    Contents of a log as a buffer
+    Plain logs are memory mapped, compressed logs are decompressed
+    '''
+    match = LOG_FILE_RE.match(os.path.basename(path))
+    if match and match.group(2):
+        with LOG_OPENERS[match.group(2)](path,'rb') as fh:
+            return fh.read()
+
+    if not os.path.getsize(path):
+        return b''
+
+    with open(path,'rb') as fh:
+        return mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+
+def log_newlines(data,start=0,end=None):
+    '''
+    Count the newlines in data[start:end] a chunk at a time - an mmap has no
+    count() before python 3.13 and slicing it whole copies the log
+    '''
+    end = len(data) if end is None else end
+    return sum([data[i:min(i + LOG_CHUNK,end)].count(b'\n') for i in range(start,end,LOG_CHUNK)])
+
+def log_scan(path,pattern=None,tail=0,limit=0):
+    '''
+    Lines of a log matching pattern (every line without one)
+        tail    Only the last <tail> lines
+        limit   Stop after <limit> lines
+    Returns [(lineno,line),...]
+    '''
+    data  = log_read(path)
+    lines = deque(maxlen=tail or None)
+
+    def decode(start,end):
+        return data[start:end].decode('utf-8','replace').rstrip('\r')
+
+    if pattern is None:
+        # Walk back from the end - only the lines we need
+        total = log_newlines(data) + (1 if len(data) and data[-1:] != b'\n' else 0)
+        end   = len(data) - (1 if data[-1:] == b'\n' else 0)
+        want  = min(tail or total,total)
+        for lineno in range(total,total - want,-1):
+            start = data.rfind(b'\n',0,end) + 1
+            lines.appendleft((lineno,decode(start,end)))
+            end   = start - 1
+        return list(lines)
+
+    regex  = re.compile(pattern.encode('utf-8') if isinstance(pattern,str) else pattern,re.M)
+    lineno = 1
+    pos    = 0
+    end    = -1
+    for match in regex.finditer(data):
+        if match.start() <= end:
+            continue    # Already have this line
+        lineno += log_newlines(data,pos,match.start())
+        pos     = match.start()
+        start   = data.rfind(b'\n',0,pos) + 1
+        end     = data.find(b'\n',pos)
+        end     = len(data) if end < 0 else end
+        lines.append((lineno,decode(start,end)))
+        if limit and len(lines) >= limit:
+            break
+
+    return list(lines)
+
+def log_index(log_file,index_file):
+    '''
+    Save the error/warning lines of a task log to index_file
+    '''
+    index = {
+        'log'      : log_file,
+        'errors'   : log_scan(log_file,LOG_ERROR,limit=LOG_INDEX_MAX),
+        'warnings' : log_scan(log_file,LOG_WARNING,limit=LOG_INDEX_MAX),
+    }
+    with open(index_file,'w') as outfile:
+        json.dump(index,outfile,indent=4,sort_keys=True)
+    return index
+
+def log_files(results_dir,tasks=None):
+    '''
+    Find task logs under a results directory
+        {task_dir : [log,...]}  Oldest rotation first
+    tasks - globs matched against the task name or its path below results_dir
+    '''
+    logs = {}
+    for (root,dirs,files) in os.walk(results_dir):
+        found = [(LOG_FILE_RE.match(f),f) for f in files]
+        found = [(int(m.group(1) or 0),f) for (m,f) in found if m]
+        if not found:
+            continue
+        rel = os.path.relpath(root,results_dir)
+        if tasks and not [t for t in tasks if fnmatch.fnmatch(rel,t) or fnmatch.fnmatch(os.path.basename(rel),t)]:
+            continue
+        # Highest rotation first - the live output.log is always newest
+        logs[root] = ["{}/{}".format(root,f) for (n,f) in sorted(found,key=lambda x: (-x[0],x[1] == "output.log",x[1]))]
+    return logs
+
+def triage_index_write(results_dir,results):
+    '''
+    Combine the task log indexes of a flow into <results_dir>/log_index.json
+    '''
+    index = {}
+    for task_dir in sorted(results):
+        entry = {
+            'status'      : results[task_dir],
+            'first_error' : None,
+            'errors'      : 0,
+            'warnings'    : 0,
+        }
+        task_index = "{}/log_index.json".format(task_dir)
+        if os.path.exists(task_index):
+            with open(task_index,'r') as fh:
+                data = json.load(fh)
+            entry['first_error'] = data['errors'][0] if data['errors'] else None
+            entry['errors']      = len(data['errors'])
+            entry['warnings']    = len(data['warnings'])
+        index[task_dir] = entry
+
+    with open("{}/log_index.json".format(results_dir),'w') as outfile:
+        json.dump(index,outfile,indent=4,sort_keys=True)
+
+def logs_cli(argv):
+    '''
+    flowb logs - search the task logs of a run
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="flowb logs",description="Search task logs of a run (output.log, rotated and compressed)")
+    parser.add_argument("-r","--results",
+                       action="store",
+                       dest="results",
+                       default="results",
+                       help="Results directory of the run"
+                       )
+    parser.add_argument("-e","--regex",
+                       action="store",
+                       dest="regex",
+                       default=None,
+                       help="Only show lines matching the regex"
+                       )
+    parser.add_argument("-i","--ignore_case",
+                       action="store_true",
+                       dest="ignore_case",
+                       default=False,
+                       help="Case insensitive --regex"
+                       )
+    parser.add_argument("-n","--tail",
+                       action="store",
+                       dest="tail",
+                       type=int,
+                       default=0,
+                       help="Only show the last N (matching) lines of each task"
+                       )
+    parser.add_argument("-j","--jobs",
+                       action="store",
+                       dest="jobs",
+                       type=int,
+                       default=os.cpu_count(),
+                       help="Number of logs scanned in parallel"
+                       )
+    parser.add_argument("-l","--list",
+                       action="store_true",
+                       dest="list",
+                       default=False,
+                       help="Only list the logs"
+                       )
+    parser.add_argument("tasks",
+                       nargs="*",
+                       help="Task name or <stage>/<task> globs to limit the search to"
+                       )
+    args = parser.parse_args(argv)
+
+    logs = log_files(args.results,args.tasks)
+    if args.list:
+        for task_dir in sorted(logs):
+            for log in logs[task_dir]:
+                print(log)
+        return 0
+
+    pattern = args.regex
+    if pattern and args.ignore_case:
+        pattern = "(?i)" + pattern
+
+    found = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = []
+        for task_dir in sorted(logs):
+            n = len(logs[task_dir])
+            jobs.append((task_dir,pool.map(log_scan,logs[task_dir],[pattern]*n,[args.tail]*n)))
+        for (task_dir,results) in jobs:
+            lines = []
+            for (log,matches) in zip(logs[task_dir],results):
+                lines.extend([(log,lineno,line) for (lineno,line) in matches])
+            # Tail spans the rotated logs of a task
+            if args.tail:
+                lines = lines[-args.tail:]
+            for (log,lineno,line) in lines:
+                print("{}:{}: {}".format(os.path.relpath(log,args.results),lineno,line))
+            found += len(lines)
+
+    # grep like exit code
+    return 0 if found or not pattern else 1
+
+def triage_cli(argv):
+    '''
+    flowb triage - first error of every failed task
+    '''
+    import argparse
+    import ast
+
+    parser = argparse.ArgumentParser(prog="flowb triage",description="Print the first error of every failed task of a run")
+    parser.add_argument("-r","--results",
+                       action="store",
+                       dest="results",
+                       default="results",
+                       help="Results directory of the run"
+                       )
+    parser.add_argument("-a","--all",
+                       action="store_true",
+                       dest="all",
+                       default=False,
+                       help="Show every task, not just failures"
+                       )
+    args = parser.parse_args(argv)
+
+    # Run level indexes - 1 per flow
+    indexes = ["{}/log_index.json".format(args.results)]
+    indexes.extend(["{}/{}/log_index.json".format(args.results,d) for d in sorted(os.listdir(args.results))] if os.path.isdir(args.results) else [])
+    indexes = [x for x in indexes if os.path.exists(x)]
+
+    index = {}
+    for f in indexes:
+        with open(f,'r') as fh:
+            index.update(json.load(fh))
+
+    if not index:
+        # Run did not finish - put an index together from the results and the logs
+        #   Stage proc_results.log is only written at the end of a stage,
+        #   proc_results.stream has every task that finished (last line wins)
+        results  = {}
+        streamed = {}
+        for (root,dirs,files) in os.walk(args.results):
+            if "proc_results.log" in files and "config.json" in files and root != args.results:
+                with open("{}/proc_results.log".format(root),'r') as fh:
+                    results.update(ast.literal_eval(fh.read() or "{}"))
+            if "proc_results.stream" in files:
+                with open("{}/proc_results.stream".format(root),'r') as fh:
+                    for line in fh:
+                        (task_dir,_,status) = line.rstrip('\n').partition('\t')
+                        if status:
+                            streamed[task_dir] = status
+        results.update(streamed)
+
+        for task_dir in results:
+            index[task_dir] = {'status':results[task_dir],'first_error':None,'errors':0,'warnings':0}
+
+    failed = 0
+    for task_dir in sorted(index):
+        entry = index[task_dir]
+        if 'FAIL' not in entry['status']:
+            if not args.all:
+                continue
+        else:
+            failed += 1
+
+        first = entry['first_error']
+        if first is None and 'FAIL' in entry['status'] and entry['errors'] == 0:
+            # Not indexed (i.e. killed run) - scan the log
+            for log in log_files(task_dir).get(task_dir,[]):
+                matches = log_scan(log,LOG_ERROR,limit=1)
+                if matches:
+                    first = matches[0]
+                    break
+
+        print("{} [{}]".format(task_dir,entry['status']))
+        if first:
+            print("   {}: {}".format(first[0],first[1]))
+
+    if not index:
+        print("No results found in [{}]".format(args.results))
+
+    return 1 if failed else 0
+
 def sig_handler(signum,frame):
     global GENERIC_ERROR
     GENERIC_ERROR = True
@@ -721,6 +2120,14 @@ if __name__ == "__main__":
     
     import argparse
 
+    # Sub commands working on the results of a run
+    #   flowb logs   [-r results] [-e regex] [-n tail] [tasks]
+    #   flowb triage [-r results]
+    if len(sys.argv) > 1 and sys.argv[1] == "logs":
+        sys.exit(logs_cli(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "triage":
+        sys.exit(triage_cli(sys.argv[2:]))
+
     parser = argparse.ArgumentParser(description="Run stages of tasks in serial or parallel")
 
     # Parse command line options
@@ -743,10 +2150,55 @@ if __name__ == "__main__":
                        help="The flow to run"
                        )
     parser.add_argument("--flow_file",
-                       action="store",
+                       action="append",
                        dest="flow_file",
                        default=None,
-                       help="Provide a specific flow file to run.  Otherwise attempt to resolve based on -p,-b,-f options"
+                       help="Provide a specific flow file to run.  Otherwise attempt to resolve based on -p,-b,-f options.  "
+                            "Repeat to run flows concurrently, <file>[@<weight>[,<priority>]]"
+                       )
+    parser.add_argument("--flows",
+                       action="append",
+                       dest="flows",
+                       default=None,
+                       help="A flow to run resolved through config.config, <project>/<branch>/<flow>[@<weight>[,<priority>]].  Repeatable"
+                       )
+    parser.add_argument("-j","--jobs",
+                       action="store",
+                       dest="jobs",
+                       type=int,
+                       default=0,
+                       help="Maximum number of tasks running at once across all flows (0 - unlimited)"
+                       )
+    parser.add_argument("--changed_since",
+                       action="store",
+                       dest="changed_since",
+                       default=None,
+                       help="Only run tasks whose inputs changed since a git revision (and their dependents)"
+                       )
+    parser.add_argument("--changed_files",
+                       action="store",
+                       dest="changed_files",
+                       default=None,
+                       help="Only run tasks whose inputs match the files listed in this file, 1 per line ('-' for stdin)"
+                       )
+    parser.add_argument("--copy_workers",
+                       action="store",
+                       dest="copy_workers",
+                       type=int,
+                       default=4,
+                       help="Number of threads copying scratch directories back to the task directories"
+                       )
+    parser.add_argument("--scratch_budget",
+                       action="append",
+                       dest="scratch_budget",
+                       default=None,
+                       help="Size limit of a scratch area, <tmpfs|local>=<size> (i.e. tmpfs=4G).  Repeatable"
+                       )
+    parser.add_argument("--scratch_dir",
+                       action="append",
+                       dest="scratch_dir",
+                       default=None,
+                       help="Directory of a scratch area, <tmpfs|local>=<dir> (defaults /dev/shm and $TMPDIR).  Repeatable"
                        )
     parser.add_argument("-p","--project",
                        action="store",
@@ -0,0 +1,72 @@
+import importlib.util
+import os
+
+FLOWB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'bin','flowb.py')
+
+spec  = importlib.util.spec_from_file_location('flowb',FLOWB)
+flowb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(flowb)
+
+def matches(glob,path):
+    return bool(flowb.glob_regex(glob).match(path))
+
+def test_glob_regex():
+    assert matches('src/*.c','src/a.c')
+    assert not matches('src/*.c','src/lib/a.c')
+    assert matches('src/**/*.c','src/a.c')
+    assert matches('src/**/*.c','src/lib/x/a.c')
+    assert not matches('src/**/*.c','src/a.h')
+    assert matches('include/','include/x/y.h')
+    assert not matches('include/','includes/y.h')
+    assert matches('a?.txt','ab.txt')
+    assert not matches('a?.txt','a/.txt')
+    assert matches('[!x]b','ab')
+    assert not matches('[!x]b','xb')
+    assert matches('v1.0','v1.0')
+    assert not matches('v1.0','v1x0')
+
+def test_glob_index_match():
+    tasks = [('S/lib',{'inputs':['src/lib/**/*.c']}),
+             ('S/doc',{'inputs':['./docs/*.md','README']}),
+             ('S/any',{'inputs':['**/Makefile']})]
+    index = flowb.glob_index(tasks)
+
+    assert flowb.glob_index_match(index,'src/lib/x/y.c') == {'S/lib'}
+    assert flowb.glob_index_match(index,'src/other.c')   == set()
+    assert flowb.glob_index_match(index,'docs/a.md')     == {'S/doc'}
+    assert flowb.glob_index_match(index,'README')        == {'S/doc'}
+    assert flowb.glob_index_match(index,'src/lib/Makefile') == {'S/any'}
+
+def affected(monkeypatch,stages,changes):
+    monkeypatch.setattr(flowb,'CHANGES',set(changes))
+    return flowb.flow_affected(stages)
+
+def test_flow_affected_depends(monkeypatch):
+    stages = [{'name':'build','tasks':[
+                 {'name':'lib' ,'inputs':['src/lib/']},
+                 {'name':'app' ,'inputs':['src/app/'],'depends':['lib']},
+                 {'name':'lint'}]},
+              {'name':'test','tasks':[
+                 {'name':'lib' ,'depends':['build/lib'],'inputs':['tests/lib/']},
+                 {'name':'unit','depends':['app'],'inputs':['tests/app/']},
+                 {'name':'docs','inputs':['docs/']}]}]
+
+    # Tasks without inputs always run, depends are followed downstream across stages
+    assert affected(monkeypatch,stages,['src/lib/a.c']) == {'build/lib','build/app','build/lint','test/lib','test/unit'}
+    assert affected(monkeypatch,stages,['docs/x.md'])   == {'build/lint','test/docs'}
+    assert affected(monkeypatch,stages,[])              == {'build/lint'}
+
+    monkeypatch.setattr(flowb,'CHANGES',None)
+    assert flowb.flow_affected(stages) is None
+
+def test_flow_affected_streams(monkeypatch):
+    stages = [{'name':'extract','tasks':[
+                 {'name':'log_extract','inputs':['logs/']}]},
+              {'name':'report','tasks':[
+                 {'name':'analysis','inputs':['analysis/'],'stream_from':'extract/log_extract'},
+                 {'name':'summary' ,'inputs':['summary/'] ,'stream_from':'analysis'}]}]
+
+    # A consumer pulls in its producer, a producer its consumer
+    assert affected(monkeypatch,stages,['analysis/a.py']) == {'extract/log_extract','report/analysis','report/summary'}
+    assert affected(monkeypatch,stages,['logs/a.txt'])    == {'extract/log_extract','report/analysis','report/summary'}
+    assert affected(monkeypatch,stages,['other'])         == set()
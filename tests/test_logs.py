@@ -0,0 +1,81 @@
+import importlib.util
+import gzip
+import lzma
+import os
+import subprocess
+import sys
+
+import pytest
+
+FLOWB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'bin','flowb.py')
+
+spec  = importlib.util.spec_from_file_location('flowb',FLOWB)
+flowb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(flowb)
+
+def flowb_cli(cwd,*args):
+    return subprocess.run([sys.executable,FLOWB] + list(args),cwd=str(cwd),stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,universal_newlines=True,timeout=60)
+
+@pytest.fixture(params=[1024**2,3],ids=['chunk','tiny_chunk'])
+def chunk(request,monkeypatch):
+    # A tiny chunk makes every newline count cross chunk boundaries
+    monkeypatch.setattr(flowb,'LOG_CHUNK',request.param)
+
+@pytest.mark.parametrize('text',['a\nerror 1\nb\nERROR 2\n','a\nerror 1\nb\nERROR 2'])
+def test_log_scan(tmp_path,chunk,text):
+    log = tmp_path / 'output.log'
+    log.write_text(text)
+
+    assert flowb.log_scan(str(log))         == [(1,'a'),(2,'error 1'),(3,'b'),(4,'ERROR 2')]
+    assert flowb.log_scan(str(log),tail=2)  == [(3,'b'),(4,'ERROR 2')]
+    assert flowb.log_scan(str(log),tail=10) == [(1,'a'),(2,'error 1'),(3,'b'),(4,'ERROR 2')]
+    assert flowb.log_scan(str(log),flowb.LOG_ERROR)          == [(2,'error 1'),(4,'ERROR 2')]
+    assert flowb.log_scan(str(log),flowb.LOG_ERROR,limit=1)  == [(2,'error 1')]
+    assert flowb.log_scan(str(log),flowb.LOG_ERROR,tail=1)   == [(4,'ERROR 2')]
+    assert flowb.log_scan(str(log),'missing') == []
+
+def test_log_scan_empty_and_compressed(tmp_path):
+    empty = tmp_path / 'output.log'
+    empty.write_text('')
+    assert flowb.log_scan(str(empty)) == []
+
+    with gzip.open(str(tmp_path / 'output.log.1.gz'),'wt') as fh:
+        fh.write('x\nerror: gz\n')
+    assert flowb.log_scan(str(tmp_path / 'output.log.1.gz'),flowb.LOG_ERROR) == [(2,'error: gz')]
+
+def test_log_files_order(tmp_path):
+    task = tmp_path / 'S0' / 'task'
+    task.mkdir(parents=True)
+    for name in ('output.log','output.log.1.gz','output.log.2','output.log.xz','other.log'):
+        (task / name).write_text('')
+    (tmp_path / 'S1' / 'skip').mkdir(parents=True)
+    (tmp_path / 'S1' / 'skip' / 'output.log').write_text('')
+
+    logs = flowb.log_files(str(tmp_path),['task'])
+
+    # Oldest rotation first - the live log is always last
+    assert list(logs) == [str(task)]
+    assert [os.path.basename(x) for x in logs[str(task)]] == ['output.log.2','output.log.1.gz','output.log.xz','output.log']
+
+def test_logs_tail_across_rotations(tmp_path):
+    task = tmp_path / 'results' / 'S0' / 'task'
+    task.mkdir(parents=True)
+    with lzma.open(str(task / 'output.log.1.xz'),'wt') as fh:
+        fh.write('old 1\nold 2\n')
+    (task / 'output.log').write_text('new 1\nnew 2\n')
+
+    out = flowb_cli(tmp_path,'logs','-n','3','task').stdout.splitlines()
+    assert out == ['S0/task/output.log.1.xz:2: old 2','S0/task/output.log:1: new 1','S0/task/output.log:2: new 2']
+
+def test_triage_unfinished_run(tmp_path):
+    # Killed mid stage - no run log_index.json and no stage proc_results.log yet
+    results = tmp_path / 'results'
+    for name in ('bad','good'):
+        (results / 'S0' / name).mkdir(parents=True)
+    (results / 'S0' / 'bad' / 'output.log').write_text('starting\nerror: broken\n')
+    (results / 'proc_results.stream').write_text('{0}/S0/bad\tFAIL\n{0}/S0/good\tPASS\n'.format(results))
+
+    out = flowb_cli(tmp_path,'triage')
+    assert out.returncode == 1
+    assert out.stdout.splitlines() == ['{}/S0/bad [FAIL]'.format(results),'   2: error: broken']
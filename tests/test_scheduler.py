@@ -0,0 +1,58 @@
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+
+FLOWB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'bin','flowb.py')
+
+spec  = importlib.util.spec_from_file_location('flowb',FLOWB)
+flowb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(flowb)
+
+def flow(name,weight=1,priority=0):
+    return {'name':name,'weight':weight,'priority':priority}
+
+def test_priority_keeps_queued_flow_slot():
+    sched = flowb.Scheduler(slots=1)
+    low   = flow('low')
+    high  = flow('high',priority=10)
+
+    assert sched.acquire(low,timeout=0)
+
+    # Both time out while the slot is busy but stay queued
+    assert not sched.acquire(high,timeout=0)
+    assert not sched.acquire(low,timeout=0)
+
+    sched.release(low)
+    assert not sched.acquire(low,timeout=0)
+    assert sched.acquire(high,timeout=0)
+
+def test_weight_shares_slots():
+    sched = flowb.Scheduler(slots=8)
+    light = flow('light')
+    heavy = flow('heavy',weight=3)
+    sched.waiting = {'light':light,'heavy':heavy}
+
+    sched.running = {'light':1,'heavy':2}
+    assert sched._next() is heavy   # 2/3 of its share vs 1/1
+
+    sched.running = {'light':1,'heavy':4}
+    assert sched._next() is light
+
+    sched.cancel(light)
+    assert sched._next() is heavy
+
+def test_two_flows_launch_order(tmp_path):
+    for name in ('low','high'):
+        stage = {'name':'S0','tasks':[{'name':'{}{}'.format(name,i),'task':None,'command':'sleep 0.3'} for i in range(3)]}
+        (tmp_path / '{}.json'.format(name)).write_text(json.dumps([stage]))
+
+    out = subprocess.run([sys.executable,FLOWB,'--flow_file','low.json','--flow_file','high.json@1,10','-j','1'],
+                         cwd=str(tmp_path),stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True,timeout=60).stdout
+    launched = re.findall(r'Launched task \[([a-z]+)\d-',out)
+
+    # Whichever flow starts first takes the only slot - every high priority task goes next
+    assert len(launched) == 6
+    assert launched[1:].index('low') >= launched[1:].count('high')
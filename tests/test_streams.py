@@ -0,0 +1,81 @@
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+FLOWB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'bin','flowb.py')
+
+spec  = importlib.util.spec_from_file_location('flowb',FLOWB)
+flowb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(flowb)
+
+def names(stage):
+    return [t['name'] for t in stage['tasks']]
+
+def test_flow_streams_same_stage():
+    stages = [{'name':'S0','tasks':[{'name':'consumer','stream_from':'producer'},{'name':'other'},{'name':'producer'}]}]
+    flowb.flow_streams(stages)
+
+    assert names(stages[0]) == ['other','producer','consumer']
+
+def test_flow_streams_chain_across_stages():
+    stages = [{'name':'extract','tasks':[{'name':'log_extract'},{'name':'other'}]},
+              {'name':'report' ,'tasks':[{'name':'report','stream_from':'analysis'},{'name':'analysis','stream_from':'extract/log_extract'}]}]
+    flowb.flow_streams(stages)
+
+    assert names(stages[0]) == ['log_extract','analysis','report','other']
+    assert names(stages[1]) == []
+
+    # Consumers remember where they were declared (change aware selection keys)
+    assert [t.get('stream_stage') for t in stages[0]['tasks']] == [None,'report','report',None]
+    assert [t.get('stream_from') for t in stages[0]['tasks']]  == [None,'log_extract','analysis',None]
+
+@pytest.mark.parametrize('tasks',[
+    [{'name':'a','stream_from':'missing'}],                                 # Unknown producer
+    [{'name':'p'},{'name':'a','stream_from':'p'},{'name':'b','stream_from':'p'}],  # 2 consumers
+    [{'name':'a','stream_from':'b'},{'name':'b','stream_from':'a'}],        # Cycle
+])
+def test_flow_streams_errors(tasks):
+    with pytest.raises(SystemExit):
+        flowb.flow_streams([{'name':'S0','tasks':tasks}])
+
+def test_stream_groups():
+    flow   = {'results':{},'results_fh':io.StringIO(),'stage_failed':False}
+    stage  = {'stage_dir':'/r/S0'}
+    tasks  = [{'name':'a'},{'name':'b','stream_from':'a'},{'name':'c','stream_from':'b'},{'name':'d'},{'name':'e','stream_from':'x'}]
+    result = {}
+    groups = flowb.stream_groups(flow,stage,tasks,result)
+
+    assert [[t['name'] for t in g] for g in groups] == [['a','b','c'],['d']]
+
+    # Producer not run (i.e. -t) - the consumer would wait forever
+    assert result == {'/r/S0/e':'SKIPPED: Stream producer [x] not run'}
+    assert not flow['stage_failed']
+
+def test_stream_run(tmp_path):
+    stage = {'name':'S0','task_continue_on_fail':True,'tasks':[
+        {'name':'seq' ,'task':None,'command':'seq 10 > $FLOWB_STREAM_OUT'},
+        {'name':'wc'  ,'task':None,'command':'wc -l < $FLOWB_STREAM_IN > count','stream_from':'seq'},
+        {'name':'yes' ,'task':None,'command':'yes > $FLOWB_STREAM_OUT'},
+        {'name':'head','task':None,'command':'head -n 5 < $FLOWB_STREAM_IN','stream_from':'yes'},
+        {'name':'bad' ,'task':None,'command':'sleep 0.5; false'},
+        {'name':'cat' ,'task':None,'command':'cat $FLOWB_STREAM_IN > got; echo done','stream_from':'bad'}]}
+    (tmp_path / 'flow.json').write_text(json.dumps([stage]))
+
+    subprocess.run([sys.executable,FLOWB,'--flow_file','flow.json'],cwd=str(tmp_path),
+                   stdout=subprocess.DEVNULL,stderr=subprocess.STDOUT,timeout=60)
+
+    results = {}
+    for line in (tmp_path / 'results' / 'proc_results.stream').read_text().splitlines():
+        (task_dir,status) = line.split('\t')
+        results[os.path.basename(task_dir)] = status
+
+    assert (tmp_path / 'results' / 'S0' / 'wc' / 'count').read_text().strip() == '10'
+    assert results['seq'] == results['wc'] == results['head'] == 'PASS'
+    assert results['yes'] == 'PASS: Stream consumer [head] finished before reading everything (SIGPIPE)'
+    assert results['bad'] == 'FAIL'
+    assert results['cat'] == 'FAIL: Killed because stream producer [bad] failed'
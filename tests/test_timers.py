@@ -0,0 +1,51 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+
+FLOWB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'bin','flowb.py')
+
+spec  = importlib.util.spec_from_file_location('flowb',FLOWB)
+flowb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(flowb)
+
+def test_timers_order_and_cancel():
+    timers = flowb.Timers()
+    fired  = []
+    done   = threading.Event()
+
+    timers.start(0.15,fired.append,'late')
+    timers.start(0.05,fired.append,'early')
+    cancel = timers.start(0.10,fired.append,'cancelled')
+    timers.start(0.20,done.set)
+    timers.cancel(cancel)
+
+    assert done.wait(5)
+    assert fired == ['early','late']
+
+def test_timers_callback_raises():
+    timers = flowb.Timers()
+    done   = threading.Event()
+
+    def bad():
+        raise RuntimeError("boom")
+
+    # Later timeouts still fire
+    timers.start(0.01,bad)
+    timers.start(0.05,done.set)
+    assert done.wait(5)
+
+def test_task_timeouts_finish(tmp_path):
+    # Timeouts landing as the tasks exit - a kill that reaps the task behind
+    # procs_reap() left the flow waiting forever
+    tasks = [{'name':'t{}'.format(i),'task':None,'command':'sleep 0.5','timeout_sec':0.5 + i * 0.0005} for i in range(60)]
+    (tmp_path / 'flow.json').write_text(json.dumps([{'name':'S0','task_continue_on_fail':True,'tasks':tasks}]))
+
+    subprocess.run([sys.executable,FLOWB,'--flow_file','flow.json'],cwd=str(tmp_path),
+                   stdout=subprocess.DEVNULL,stderr=subprocess.STDOUT,timeout=60)
+
+    lines = (tmp_path / 'results' / 'proc_results.stream').read_text().splitlines()
+    assert len(lines) == len(tasks)
+    assert set([x.split('\t')[1] for x in lines]) <= {'PASS','FAIL: Task timed out'}